@@ -1,77 +1,398 @@
+import io
 import logging
-import tempfile
+import multiprocessing
 import os
-from typing import List
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import Dict, List
 import pandas as pd
 from langchain.schema import Document
 
+try:
+    import polars as pl
+except ImportError:
+    pl = None
+
+try:
+    from pyarrow import csv as pacsv
+except ImportError:
+    pacsv = None
+
 logger = logging.getLogger(__name__)
 
-def _df_to_text(df: pd.DataFrame, title: str) -> str:
-    """Convert DataFrame to comprehensive text representation with ALL data"""
+# Worker processes are started from Streamlit's multi-threaded server, where a
+# plain fork can copy a lock another thread holds and deadlock the child.
+# forkserver (spawn on Windows) starts workers from a clean single-threaded process.
+# Shared with the PDF extractor's worker pools
+MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+# CSVs above this size are streamed in row chunks instead of loaded whole
+CSV_STREAM_BYTES = 64 * 1024 * 1024
+CSV_CHUNK_ROWS = 50_000
+# Distinct values counted per text column while streaming before the column is
+# reported as high-cardinality instead
+CSV_MAX_TRACKED_VALUES = 10_000
+
+# Below this many sheet rows per worker, starting worker processes and pickling
+# the frames to them cost more than formatting the sheets serially
+MIN_ROWS_PER_WORKER = 50_000
+
+# pandas' default missing-value tokens, handed to polars/pyarrow so every
+# reader turns "NA", "N/A", "null" etc. into missing values the same way
+CSV_NA_VALUES = [
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan",
+    "1.#IND", "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None",
+    "n/a", "nan", "null",
+]
+
+def _read_csv(buf: io.BytesIO) -> pd.DataFrame:
+    """Read CSV with polars or pyarrow's multithreaded parsers, falling back to pandas"""
+    if pl is not None:
+        try:
+            buf.seek(0)
+            # No ignore_errors or truncate_ragged_lines: a value that doesn't fit the
+            # inferred schema or a row with extra fields must raise and fall through
+            # to the readers that skip bad rows, not become null or shifted values
+            return pl.read_csv(buf, null_values=CSV_NA_VALUES,
+                               infer_schema_length=10000).to_pandas()
+        except Exception as e:
+            logger.warning(f"polars CSV read failed, trying pyarrow: {e}")
+    if pacsv is not None:
+        try:
+            buf.seek(0)
+            tbl = pacsv.read_csv(
+                buf,
+                # Skip only rows with too many fields, as pandas' on_bad_lines='skip' does;
+                # a short row must raise so pandas reads it with the missing fields as NaN
+                parse_options=pacsv.ParseOptions(
+                    invalid_row_handler=lambda row: "skip" if row.actual_columns > row.expected_columns else "error"
+                ),
+                convert_options=pacsv.ConvertOptions(null_values=CSV_NA_VALUES, strings_can_be_null=True)
+            )
+            return tbl.to_pandas(self_destruct=True)
+        except Exception as e:
+            logger.warning(f"pyarrow CSV read failed, falling back to pandas: {e}")
+    buf.seek(0)
+    return pd.read_csv(buf, encoding='utf-8', on_bad_lines='skip')
+
+def _read_excel(buf: io.BytesIO) -> Dict[str, pd.DataFrame]:
+    """Read all sheets, trying the Rust calamine engine before openpyxl/xlrd"""
+    # pandas already opens openpyxl workbooks read_only/data_only
+    engines = ["calamine", "openpyxl", "xlrd"]
+    for i, engine in enumerate(engines):
+        try:
+            buf.seek(0)
+            return pd.read_excel(buf, sheet_name=None, engine=engine)
+        except Exception as e:
+            if i == len(engines) - 1:
+                raise
+            logger.warning(f"Excel read with {engine} failed: {e}")
+
+def _downcast_text_cols(df: pd.DataFrame) -> pd.DataFrame:
+    """Store low-cardinality text columns as category so scans hit integer codes"""
+    for col in df.select_dtypes(include=['object']).columns:
+        if df[col].nunique() < len(df) // 2:
+            df[col] = df[col].astype('category')
+    return df
+
+def _column_cells(series: pd.Series, prefix: str) -> List[str]:
+    """Render one column as "prefix+value" strings"""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        # Format each category once and index by code; code -1 (missing) hits the trailing "nan"
+        lookup = [prefix + str(c) for c in series.cat.categories] + [prefix + "nan"]
+        return [lookup[code] for code in series.cat.codes.tolist()]
+    return [prefix + s for s in map(str, series.tolist())]
+
+def _numeric_stats(df: pd.DataFrame, numeric_cols) -> pd.DataFrame:
+    """sum/mean/count/min/max for every numeric column in one vectorized pass"""
+    return df[numeric_cols].agg(['sum', 'mean', 'count', 'min', 'max'])
+
+def _df_to_text(df: pd.DataFrame, title: str, *, numeric_cols=None, text_cols=None, stats=None) -> str:
+    """Convert DataFrame to comprehensive text representation with ALL data
+
+    numeric_cols/text_cols can be passed in when formatting many slices of the
+    same frame (groups, row chunks) so dtype selection isn't redone per slice.
+    stats lets a caller that already ran _numeric_stats on df reuse it.
+    """
     if df.empty:
         return ""
     
-    lines = [
-        f"=== {title} ===",
-        f"Total Rows: {len(df)}",
-        f"Total Columns: {len(df.columns)}",
-        "",
-        "COLUMN HEADERS: " + " | ".join(str(col) for col in df.columns),
-        ""
-    ]
+    # Write into one contiguous buffer rather than a list of millions of short lines
+    buf = io.StringIO()
+    buf.write(f"=== {title} ===\n")
+    buf.write(f"Total Rows: {len(df)}\n")
+    buf.write(f"Total Columns: {len(df.columns)}\n")
+    buf.write("\n")
+    buf.write("COLUMN HEADERS: " + " | ".join(str(col) for col in df.columns) + "\n")
+    buf.write("\n")
     
     # Add complete numerical summary
-    numeric_cols = df.select_dtypes(include=['number']).columns
+    if numeric_cols is None:
+        numeric_cols = df.select_dtypes(include=['number']).columns
     if len(numeric_cols) > 0:
-        lines.append("=== NUMERICAL SUMMARY ===")
+        buf.write("=== NUMERICAL SUMMARY ===\n")
+        if stats is None:
+            stats = _numeric_stats(df, numeric_cols)
         for col in numeric_cols:
-            total = df[col].sum()
-            mean = df[col].mean()
-            count = df[col].count()
-            min_val = df[col].min()
-            max_val = df[col].max()
-            lines.append(f"{col}: TOTAL={total:.2f}, AVERAGE={mean:.2f}, COUNT={count}, MIN={min_val:.2f}, MAX={max_val:.2f}")
-        lines.append("")
+            s = stats[col]
+            buf.write(f"{col}: TOTAL={s['sum']:.2f}, AVERAGE={s['mean']:.2f}, COUNT={int(s['count'])}, MIN={s['min']:.2f}, MAX={s['max']:.2f}\n")
+        buf.write("\n")
     
     # Add categorical summary
-    text_cols = df.select_dtypes(include=['object']).columns
+    if text_cols is None:
+        text_cols = df.select_dtypes(include=['object', 'category']).columns
     if len(text_cols) > 0:
-        lines.append("=== CATEGORICAL SUMMARY ===")
+        buf.write("=== CATEGORICAL SUMMARY ===\n")
         for col in text_cols:
             unique_count = df[col].nunique()
-            top_values = df[col].value_counts().head(10)
-            lines.append(f"{col}: {unique_count} unique values")
+            # Partial selection of the top 10 instead of sorting the full histogram
+            top_values = df[col].value_counts(sort=False).nlargest(10)
+            top_values = top_values[top_values > 0]  # slices keep unobserved categories
+            buf.write(f"{col}: {unique_count} unique values\n")
             for value, count in top_values.items():
-                lines.append(f"  {value}: {count} occurrences")
-        lines.append("")
+                buf.write(f"  {value}: {count} occurrences\n")
+        buf.write("\n")
     
     # *** CRITICAL: INCLUDE ALL DATA ROWS ***
-    lines.append("=== ALL DATA ROWS ===")
-    for i, (_, row) in enumerate(df.iterrows()):
-        row_data = " | ".join(f"{col}:{str(row[col])}" for col in df.columns)
-        lines.append(f"Row {i+1}: {row_data}")
+    buf.write("=== ALL DATA ROWS ===")
+    # Format column-at-a-time (tolist() yields native scalars, so str() runs in C),
+    # then stitch rows together - no Series built and no per-cell type checks
+    cells = [_column_cells(df[col], f"{col}:") for col in df.columns]
+    for i, row_data in enumerate(map(" | ".join, zip(*cells)), 1):
+        buf.write(f"\nRow {i}: {row_data}")
+    
+    return buf.getvalue()
+
+def _process_sheet(filename: str, sheet_name: str, df: pd.DataFrame) -> List[Document]:
+    """Build the full-sheet document plus row-range chunks for one sheet"""
+    docs = []
+    df = _downcast_text_cols(df.fillna(""))
+    
+    logger.info(f"Excel sheet '{sheet_name}': {len(df)} rows, {len(df.columns)} columns")
+    
+    # Create comprehensive sheet document
+    content = _df_to_text(df, f"Excel Sheet: {sheet_name}")
+    docs.append(Document(
+        page_content=content,
+        metadata={
+            "source": filename,
+            "sheet": sheet_name,
+            "type": "excel_sheet_complete",
+            "rows": len(df),
+            "columns": len(df.columns),
+            "original_filename": filename
+        }
+    ))
     
-    return "\n".join(lines)
+    # Create additional chunks for large sheets
+    if len(df) > 200:
+        chunk_size = 200
+        numeric_cols = df.select_dtypes(include=['number']).columns
+        text_cols = df.select_dtypes(include=['object', 'category']).columns
+        for i in range(0, len(df), chunk_size):
+            chunk_df = df.iloc[i:i+chunk_size]
+            chunk_content = _df_to_text(chunk_df, f"Sheet {sheet_name} - Rows {i+1} to {i+len(chunk_df)}",
+                                        numeric_cols=numeric_cols, text_cols=text_cols)
+            docs.append(Document(
+                page_content=chunk_content,
+                metadata={
+                    "source": filename,
+                    "sheet": sheet_name,
+                    "type": "excel_chunk",
+                    "chunk_start": i+1,
+                    "chunk_end": i+len(chunk_df),
+                    "rows": len(chunk_df),
+                    "original_filename": filename
+                }
+            ))
+    return docs
+
+def _extract_csv_streaming(buf: io.BytesIO, filename: str) -> List[Document]:
+    """Stream a large CSV in row chunks, keeping only running aggregates in memory"""
+    docs = []
+    columns, n_rows = [], 0
+    num_stats = {}   # col -> [sum, count, min, max]
+    cat_counts = {}  # col -> Counter of values, None once past CSV_MAX_TRACKED_VALUES
+    group_rows = {}  # col -> Counter of rows per value
+    group_sums = {}  # col -> {value: {numeric col: sum}}
+    non_groupable = set()
+    numeric_cols = None
+    
+    for chunk in pd.read_csv(buf, encoding='utf-8', on_bad_lines='skip', chunksize=CSV_CHUNK_ROWS):
+        if not columns:
+            columns = chunk.columns.tolist()
+        start = n_rows + 1
+        n_rows += len(chunk)
+        
+        # pandas infers dtypes per chunk, so numeric columns are fixed by the first
+        # chunk; a later chunk where one reads as text is coerced, not dropped
+        if numeric_cols is None:
+            numeric_cols = chunk.select_dtypes(include=['number']).columns.tolist()
+        nums = chunk[numeric_cols]
+        mistyped = [c for c in numeric_cols if not pd.api.types.is_numeric_dtype(nums[c])]
+        if mistyped:
+            nums = nums.copy()
+            for col in mistyped:
+                coerced = pd.to_numeric(nums[col], errors='coerce')
+                failed = int((coerced.isna() & nums[col].notna()).sum())
+                logger.warning(f"CSV rows {start}-{n_rows}: {failed} non-numeric values in '{col}' ignored in totals")
+                nums[col] = coerced
+        
+        # Numeric aggregates before fillna so NaNs are skipped, not stringified
+        if numeric_cols:
+            stats = nums.agg(['sum', 'count', 'min', 'max'])
+            for col in numeric_cols:
+                s = stats[col]
+                if not s['count']:
+                    continue
+                acc = num_stats.setdefault(col, [0.0, 0, s['min'], s['max']])
+                acc[0] += s['sum']
+                acc[1] += int(s['count'])
+                acc[2] = min(acc[2], s['min'])
+                acc[3] = max(acc[3], s['max'])
+        
+        chunk = chunk.fillna("")
+        text_cols = [c for c in chunk.select_dtypes(include=['object']).columns if c not in numeric_cols]
+        for col in text_cols:
+            counts = cat_counts.setdefault(col, Counter())
+            if counts is None:
+                continue
+            counts.update(chunk[col].value_counts().to_dict())
+            # Track per-group totals only while the column still looks categorical
+            if len(counts) >= 20 and col not in non_groupable:
+                non_groupable.add(col)
+                group_rows.pop(col, None)
+                group_sums.pop(col, None)
+            # Stop counting ID-like columns so memory stays bounded
+            if len(counts) > CSV_MAX_TRACKED_VALUES:
+                cat_counts[col] = None
+            if col in non_groupable:
+                continue
+            group_rows.setdefault(col, Counter()).update(chunk.groupby(col, sort=False).size().to_dict())
+            if numeric_cols:
+                sums = group_sums.setdefault(col, {})
+                chunk_sums = nums.groupby(chunk[col], sort=False).sum()
+                for value, row in chunk_sums.to_dict('index').items():
+                    value_sums = sums.setdefault(value, {})
+                    for num_col, total in row.items():
+                        value_sums[num_col] = value_sums.get(num_col, 0.0) + total
+        
+        docs.append(Document(
+            page_content=_df_to_text(chunk, f"CSV Rows {start} to {n_rows}"),
+            metadata={
+                "source": filename,
+                "type": "csv_chunk",
+                "chunk_start": start,
+                "chunk_end": n_rows,
+                "rows": len(chunk),
+                "original_filename": filename
+            }
+        ))
+    
+    logger.info(f"CSV streaming extraction: {n_rows} rows, {len(columns)} columns")
+    
+    # Dataset overview assembled from the running aggregates
+    lines = [
+        "=== Complete CSV Dataset ===",
+        f"Total Rows: {n_rows}",
+        f"Total Columns: {len(columns)}",
+        "",
+        "COLUMN HEADERS: " + " | ".join(str(col) for col in columns),
+        ""
+    ]
+    if num_stats:
+        lines.append("=== NUMERICAL SUMMARY ===")
+        for col, (total, count, min_val, max_val) in num_stats.items():
+            lines.append(f"{col}: TOTAL={total:.2f}, AVERAGE={total / count:.2f}, COUNT={count}, MIN={min_val:.2f}, MAX={max_val:.2f}")
+        lines.append("")
+    if cat_counts:
+        lines.append("=== CATEGORICAL SUMMARY ===")
+        for col, counts in cat_counts.items():
+            if counts is None:
+                lines.append(f"{col}: more than {CSV_MAX_TRACKED_VALUES} unique values")
+                continue
+            lines.append(f"{col}: {len(counts)} unique values")
+            for value, count in counts.most_common(10):
+                lines.append(f"  {value}: {count} occurrences")
+    docs.append(Document(
+        page_content="\n".join(lines),
+        metadata={
+            "source": filename,
+            "type": "csv_overview",
+            "rows": n_rows,
+            "columns": len(columns),
+            "original_filename": filename
+        }
+    ))
+    
+    # Grouped aggregates for the first categorical column
+    for col in columns:
+        if group_rows.get(col):
+            for value, rows in group_rows[col].items():
+                if rows < 2:
+                    continue
+                group_lines = [f"=== Category Group - {col}: {value} ===", f"Total Rows: {rows}"]
+                for num_col, total in group_sums.get(col, {}).get(value, {}).items():
+                    group_lines.append(f"{num_col} TOTAL: {total:.2f}")
+                docs.append(Document(
+                    page_content="\n".join(group_lines),
+                    metadata={
+                        "source": filename,
+                        "type": "csv_group",
+                        "group_column": col,
+                        "group_value": str(value),
+                        "rows": rows,
+                        "original_filename": filename
+                    }
+                ))
+            break  # Only group by first suitable column
+    
+    if num_stats:
+        summary_lines = ["=== FINANCIAL SUMMARY ==="]
+        for col, (total, count, _, _) in num_stats.items():
+            summary_lines.append(f"{col} TOTAL: {total:.2f}")
+            summary_lines.append(f"{col} AVERAGE: {total / count:.2f}")
+            summary_lines.append(f"{col} COUNT: {count}")
+        docs.append(Document(
+            page_content="\n".join(summary_lines),
+            metadata={
+                "source": filename,
+                "type": "financial_summary",
+                "focus": "numerical_aggregates",
+                "original_filename": filename
+            }
+        ))
+    return docs
 
 def extract_from_excel(uploaded_file) -> List[Document]:
     """Enhanced Excel extraction that processes ALL data completely"""
-    docs, tmp = [], None
+    docs = []
     try:
-        suffix = ".csv" if uploaded_file.name.lower().endswith(".csv") else ".xlsx"
-        tmp = tempfile.mktemp(suffix=suffix)
-        with open(tmp, "wb") as fh:
-            fh.write(uploaded_file.getbuffer())
+        is_csv = uploaded_file.name.lower().endswith(".csv")
+        # Parse straight from the in-memory upload; no temp file round-trip
+        data = uploaded_file.getbuffer()
+        buf = io.BytesIO(data)
 
-        if suffix == ".csv":
+        if is_csv and data.nbytes > CSV_STREAM_BYTES:
+            docs.extend(_extract_csv_streaming(buf, uploaded_file.name))
+        
+        elif is_csv:
             # Read entire CSV file without limits
-            df = pd.read_csv(tmp, encoding='utf-8', on_bad_lines='skip')
-            df = df.fillna("")
+            df = _read_csv(buf)
+            df = _downcast_text_cols(df.fillna(""))
             
             logger.info(f"CSV extraction: {len(df)} rows, {len(df.columns)} columns")
             
+            numeric_cols = df.select_dtypes(include=['number']).columns
+            text_cols = df.select_dtypes(include=['object', 'category']).columns
+            stats = _numeric_stats(df, numeric_cols) if len(numeric_cols) > 0 else None
+            
             # Create main document with ALL data
-            content = _df_to_text(df, "Complete CSV Dataset")
+            content = _df_to_text(df, "Complete CSV Dataset",
+                                  numeric_cols=numeric_cols, text_cols=text_cols, stats=stats)
             docs.append(Document(
                 page_content=content,
                 metadata={
@@ -86,10 +407,11 @@ def extract_from_excel(uploaded_file) -> List[Document]:
             # Create additional grouped chunks for better retrieval
             if len(df) > 100:  # Lower threshold for grouping
                 for col in df.columns:
-                    if df[col].dtype == 'object' and df[col].nunique() < 20:
-                        for group_name, group_df in df.groupby(col):
+                    if col in text_cols and df[col].nunique() < 20:
+                        for group_name, group_df in df.groupby(col, sort=False, observed=True):
                             if len(group_df) > 1:  # Include even small groups
-                                group_content = _df_to_text(group_df, f"Category Group - {col}: {group_name}")
+                                group_content = _df_to_text(group_df, f"Category Group - {col}: {group_name}",
+                                                            numeric_cols=numeric_cols, text_cols=text_cols)
                                 docs.append(Document(
                                     page_content=group_content,
                                     metadata={
@@ -103,17 +425,14 @@ def extract_from_excel(uploaded_file) -> List[Document]:
                                 ))
                         break  # Only group by first suitable column
             
-            # Create financial summary chunk for numerical data
-            numeric_cols = df.select_dtypes(include=['number']).columns
-            if len(numeric_cols) > 0:
+            # Create financial summary chunk from the stats already computed above
+            if stats is not None:
                 summary_lines = ["=== FINANCIAL SUMMARY ==="]
                 for col in numeric_cols:
-                    total = df[col].sum()
-                    avg = df[col].mean()
-                    count = df[col].count()
-                    summary_lines.append(f"{col} TOTAL: {total:.2f}")
-                    summary_lines.append(f"{col} AVERAGE: {avg:.2f}")
-                    summary_lines.append(f"{col} COUNT: {count}")
+                    s = stats[col]
+                    summary_lines.append(f"{col} TOTAL: {s['sum']:.2f}")
+                    summary_lines.append(f"{col} AVERAGE: {s['mean']:.2f}")
+                    summary_lines.append(f"{col} COUNT: {int(s['count'])}")
                 
                 summary_content = "\n".join(summary_lines)
                 docs.append(Document(
@@ -128,48 +447,21 @@ def extract_from_excel(uploaded_file) -> List[Document]:
             
         else:
             # Read Excel with all sheets and all rows
-            try:
-                sheets = pd.read_excel(tmp, sheet_name=None, engine='openpyxl')
-            except:
-                sheets = pd.read_excel(tmp, sheet_name=None, engine='xlrd')
+            sheets = _read_excel(buf)
             
-            for sheet_name, df in sheets.items():
-                df = df.fillna("")
-                
-                logger.info(f"Excel sheet '{sheet_name}': {len(df)} rows, {len(df.columns)} columns")
-                
-                # Create comprehensive sheet document
-                content = _df_to_text(df, f"Excel Sheet: {sheet_name}")
-                docs.append(Document(
-                    page_content=content,
-                    metadata={
-                        "source": uploaded_file.name,
-                        "sheet": sheet_name,
-                        "type": "excel_sheet_complete",
-                        "rows": len(df),
-                        "columns": len(df.columns),
-                        "original_filename": uploaded_file.name
-                    }
-                ))
-                
-                # Create additional chunks for large sheets
-                if len(df) > 200:
-                    chunk_size = 200
-                    for i in range(0, len(df), chunk_size):
-                        chunk_df = df.iloc[i:i+chunk_size]
-                        chunk_content = _df_to_text(chunk_df, f"Sheet {sheet_name} - Rows {i+1} to {i+len(chunk_df)}")
-                        docs.append(Document(
-                            page_content=chunk_content,
-                            metadata={
-                                "source": uploaded_file.name,
-                                "sheet": sheet_name,
-                                "type": "excel_chunk",
-                                "chunk_start": i+1,
-                                "chunk_end": i+len(chunk_df),
-                                "rows": len(chunk_df),
-                                "original_filename": uploaded_file.name
-                            }
-                        ))
+            tasks = list(sheets.items())
+            total_rows = sum(len(df) for df in sheets.values())
+            workers = min(len(tasks), os.cpu_count() or 1, total_rows // MIN_ROWS_PER_WORKER)
+            if workers > 1:
+                # Sheets are independent; format them in parallel worker processes
+                with ProcessPoolExecutor(max_workers=workers, mp_context=MP_CONTEXT) as executor:
+                    sheet_names, frames = zip(*tasks)
+                    results = executor.map(_process_sheet, repeat(uploaded_file.name), sheet_names, frames)
+                    for sheet_docs in results:
+                        docs.extend(sheet_docs)
+            else:
+                for sheet_name, df in tasks:
+                    docs.extend(_process_sheet(uploaded_file.name, sheet_name, df))
         
         logger.info(f"Excel/CSV extraction completed: {len(docs)} documents created from {uploaded_file.name}")
         return docs
@@ -180,6 +472,3 @@ def extract_from_excel(uploaded_file) -> List[Document]:
             page_content=f"Error extracting Excel/CSV data: {str(e)}",
             metadata={"source": uploaded_file.name, "error": str(e)}
         )]
-    finally:
-        if tmp and os.path.exists(tmp):
-            os.remove(tmp)
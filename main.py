@@ -1,8 +1,15 @@
-import json
+import hashlib
 import logging
+import pickle
+from pathlib import Path
 import streamlit as st
 import ollama
 
+try:
+    from blake3 import blake3 as _hasher
+except ImportError:
+    _hasher = hashlib.blake2b
+
 from extractors.pdf_extraction import extract_from_pdf
 from extractors.excel_extraction import extract_from_excel
 from langchain.schema import Document
@@ -11,6 +18,11 @@ from processing.qa_pipeline import create_vector_db, process_question_with_rag
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
+# Extracted documents are cached on disk by content hash and extractor version;
+# bump EXTRACTOR_VERSION whenever extraction output changes so stale pickles are ignored
+DOC_CACHE_DIR = Path(".doc_cache")
+EXTRACTOR_VERSION = 1
+
 st.set_page_config(page_title="Financial Assistant RAG", page_icon="💰", layout="wide")
 
 @st.cache_data(show_spinner=False)
@@ -21,11 +33,69 @@ def get_ollama_models():
         logger.error(f"Ollama error: {e}")
         return []
 
+def file_digest(file, chunk_size=1 << 20):
+    """Stable content hash of an uploaded file, streamed in 1 MB chunks"""
+    h = _hasher()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(chunk_size), b""):
+        h.update(chunk)
+    file.seek(0)
+    return h.hexdigest()
+
+def extract_documents(file):
+    ext = file.name.lower().split(".")[-1]
+    if ext == "pdf":
+        return extract_from_pdf(file)
+    elif ext in ["xlsx", "xls", "csv"]:
+        return extract_from_excel(file)
+    elif ext == "txt":
+        txt = file.read().decode("utf-8", errors="ignore")
+        return [Document(txt, metadata={"source": file.name, "type": "text"})]
+    else:
+        txt = file.read().decode("utf-8", errors="ignore")
+        return [Document(txt, metadata={"source": file.name, "type": "unknown"})]
+
+def _doc_cache_path(file_hash, filename):
+    # The extension picks the extractor, so the same bytes as .txt and .csv differ
+    ext = filename.lower().split(".")[-1]
+    return DOC_CACHE_DIR / f"{file_hash}-{ext}-v{EXTRACTOR_VERSION}.pkl"
+
+def load_cached_docs(file_hash, filename):
+    """Return previously extracted documents for this content hash, if any"""
+    cache_path = _doc_cache_path(file_hash, filename)
+    if not cache_path.exists():
+        return None
+    try:
+        with open(cache_path, "rb") as fh:
+            docs = pickle.load(fh)
+        # The cache may come from an upload under another name; relabel for this one
+        for d in docs:
+            d.metadata["source"] = filename
+            if "original_filename" in d.metadata:
+                d.metadata["original_filename"] = filename
+        logger.info(f"Loaded {len(docs)} cached documents for {file_hash[:12]}")
+        return docs
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable doc cache {cache_path}: {e}")
+        return None
+
+def save_cached_docs(file_hash, filename, docs):
+    """Persist extracted documents so re-uploads skip extraction/OCR"""
+    if not docs or any("error" in d.metadata for d in docs):
+        return
+    try:
+        DOC_CACHE_DIR.mkdir(exist_ok=True)
+        with open(_doc_cache_path(file_hash, filename), "wb") as fh:
+            pickle.dump(docs, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        logger.warning(f"Could not write doc cache: {e}")
+
 @st.cache_resource(show_spinner=True)
-def cached_create_vector_db(docs_json, file_hash):
-    docs = [Document(**d) for d in json.loads(docs_json)]
-    logger.info(f"Creating vector DB with {len(docs)} documents")
-    return create_vector_db(docs)
+def cached_create_vector_db(file_hash, _docs):
+    # Keyed on the content hash alone: Streamlit leaves "_"-prefixed args out
+    # of the cache key, so it never hashes the documents
+    logger.info(f"Creating vector DB with {len(_docs)} documents")
+    return create_vector_db(_docs)
 
 def main():
     st.session_state.setdefault("messages", [])
@@ -33,6 +103,7 @@ def main():
     st.session_state.setdefault("last_uploaded_filename", None)
     st.session_state.setdefault("processing_complete", False)
     st.session_state.setdefault("file_hash", None)
+    st.session_state.setdefault("file_hash_prekey", None)
 
     st.sidebar.header("⚙️ Settings")
     
@@ -57,6 +128,7 @@ def main():
             st.session_state["last_uploaded_filename"] = None
             st.session_state["processing_complete"] = False
             st.session_state["file_hash"] = None
+            st.session_state["file_hash_prekey"] = None
             
             st.sidebar.success("✅ Vector DB cleared successfully!")
             st.rerun()
@@ -73,8 +145,14 @@ def main():
     )
 
     if file:
-        file_hash = str(hash(file.read()))
-        file.seek(0)
+        # Streamlit reruns the script on every interaction; only re-read and
+        # hash the upload when its cheap identity (upload id, name, size) changes
+        prekey = (getattr(file, "file_id", None), file.name, file.size)
+        if st.session_state["file_hash_prekey"] == prekey and st.session_state["file_hash"]:
+            file_hash = st.session_state["file_hash"]
+        else:
+            file_hash = file_digest(file)
+            st.session_state["file_hash_prekey"] = prekey
         
         if (st.session_state["last_uploaded_filename"] != file.name or 
             st.session_state["file_hash"] != file_hash):
@@ -91,28 +169,16 @@ def main():
             if st.button("🚀 Process Document", type="primary"):
                 with st.spinner("🔎 Indexing document…"):
                     try:
-                        ext = file.name.lower().split(".")[-1]
-                        if ext == "pdf":
-                            docs = extract_from_pdf(file)
-                        elif ext in ["xlsx", "xls", "csv"]:
-                            docs = extract_from_excel(file)
-                        elif ext == "txt":
-                            txt = file.read().decode("utf-8", errors="ignore")
-                            docs = [Document(txt, metadata={"source": file.name, "type": "text"})]
-                        else:
-                            txt = file.read().decode("utf-8", errors="ignore")
-                            docs = [Document(txt, metadata={"source": file.name, "type": "unknown"})]
+                        docs = load_cached_docs(file_hash, file.name)
+                        if docs is None:
+                            docs = extract_documents(file)
+                            save_cached_docs(file_hash, file.name, docs)
 
                         if not docs:
                             st.error("No data extracted from the file!")
                             return
 
-                        try:
-                            docs_json = json.dumps([d.model_dump() for d in docs])
-                        except AttributeError:
-                            docs_json = json.dumps([d.dict() for d in docs])
-                        
-                        st.session_state["vector_db"] = cached_create_vector_db(docs_json, file_hash)
+                        st.session_state["vector_db"] = cached_create_vector_db(file_hash, docs)
                         st.session_state["processing_complete"] = True
                         
                         st.success(f"✅ Successfully indexed {len(docs)} document chunks!")
@@ -141,6 +207,7 @@ def main():
             st.session_state["messages"] = []
             st.session_state["processing_complete"] = False
             st.session_state["file_hash"] = None
+            st.session_state["file_hash_prekey"] = None
         
         st.info("👆 Please upload a document to get started")
 
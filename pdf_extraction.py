@@ -1,47 +1,200 @@
+import io
 import logging
-import tempfile
 import os
-from typing import List
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import repeat
+from typing import List, Optional, Tuple
 import pdfplumber
 from PyPDF2 import PdfReader
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_bytes
 import pytesseract
 from langchain.schema import Document
+from extractors.excel_extraction import MP_CONTEXT
+
+# One OCR process per core already; stop each Tesseract spawning its own OpenMP
+# threads. libgomp reads this once when libtesseract loads, so it has to be set
+# before tesserocr is imported; the tesseract binary pytesseract runs inherits it
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+# Optional: tesserocr keeps Tesseract loaded in-process instead of spawning
+# a tesseract binary per page (needs libtesseract headers to install)
+try:
+    from tesserocr import OEM, PSM, PyTessBaseAPI
+except ImportError:
+    PyTessBaseAPI = None
 
 logger = logging.getLogger(__name__)
 
-def _text_pdfplumber(path: str) -> List[Document]:
+# LSTM engine only, single uniform text block per page
+OCR_CONFIG = "--oem 1 --psm 6"
+
+# Below this many pages per worker, process start-up and re-parsing the PDF
+# in each worker cost more than a serial pdfplumber pass
+MIN_PAGES_PER_WORKER = 8
+
+# One Tesseract API per OCR worker process, created by _init_ocr_worker
+_tess_api = None
+
+def _init_ocr_worker():
+    global _tess_api
+    if PyTessBaseAPI is None:
+        return
+    # A failure here would break the pool; leave _tess_api unset so pages use pytesseract
+    try:
+        _tess_api = PyTessBaseAPI(oem=OEM.LSTM_ONLY, psm=PSM.SINGLE_BLOCK)
+    except Exception as e:
+        logger.warning(f"tesserocr init failed, using pytesseract: {e}")
+        _tess_api = None
+
+def _ocr_image(img) -> str:
+    if _tess_api is not None:
+        _tess_api.SetImage(img)
+        return _tess_api.GetUTF8Text()
+    return pytesseract.image_to_string(img, config=OCR_CONFIG)
+
+def _page_runs(pages: List[int], max_len: int) -> List[Tuple[int, int]]:
+    """Group sorted page numbers into contiguous (first, last) runs of at most max_len pages"""
+    runs = []
+    for p in pages:
+        if runs and p == runs[-1][1] + 1 and p - runs[-1][0] < max_len:
+            runs[-1] = (runs[-1][0], p)
+        else:
+            runs.append((p, p))
+    return runs
+
+def _page_ranges(n_pages: int, n_workers: int) -> List[Tuple[int, int]]:
+    """Split [0, n_pages) into at most n_workers contiguous ranges"""
+    step = max(1, -(-n_pages // max(n_workers, 1)))
+    return [(s, min(s + step, n_pages)) for s in range(0, n_pages, step)]
+
+def _page_tables(page, p: int, source: str) -> List[Document]:
+    """Format every table found on one pdfplumber page"""
     docs = []
+    tables = page.extract_tables() or []
+    for t_idx, tbl in enumerate(tables, 1):
+        if not tbl:
+            continue
+            
+        # Better table processing
+        rows = []
+        headers = None
+        
+        for row_idx, row in enumerate(tbl):
+            if not any(cell for cell in row if cell):  # Skip empty rows
+                continue
+                
+            clean_row = [str(cell or "").strip() for cell in row]
+            
+            if row_idx == 0 and not headers:
+                headers = clean_row
+                rows.append("HEADERS: " + " | ".join(headers))
+            else:
+                if headers:
+                    row_data = []
+                    for i, cell in enumerate(clean_row):
+                        col_name = headers[i] if i < len(headers) else f"Col{i+1}"
+                        row_data.append(f"{col_name}: {cell}")
+                    rows.append(" | ".join(row_data))
+                else:
+                    rows.append(" | ".join(clean_row))
+        
+        if rows:
+            table_content = f"TABLE {t_idx} (Page {p}):\n" + "\n".join(rows)
+            docs.append(Document(
+                page_content=table_content,
+                metadata={
+                    "source": source,
+                    "page": p,
+                    "type": "table",
+                    "table_id": t_idx,
+                    "rows": len(rows),
+                    "method": "table_extraction"
+                }
+            ))
+    return docs
+
+def _pdfplumber_range(data: bytes, source: str, start: int, end: int) -> Tuple[List[Document], List[Document], List[int]]:
+    """Extract text and tables from pages [start, end) in one pass; runs inside a worker process
+
+    Also returns the pages that have no text but do carry images (scans), the
+    only pages worth OCR; blank separator pages are left out.
+    """
+    text_docs, table_docs, image_pages = [], [], []
+    with pdfplumber.open(io.BytesIO(data)) as pdf:
+        for i, page in enumerate(pdf.pages[start:end], start + 1):
+            txt = page.extract_text() or ""
+            if txt.strip():
+                text_docs.append(Document(
+                    page_content=txt,
+                    metadata={
+                        "source": source,
+                        "page": i,
+                        "method": "pdfplumber",
+                        "char_count": len(txt)
+                    }
+                ))
+            elif page.images:
+                image_pages.append(i)
+            try:
+                table_docs.extend(_page_tables(page, i, source))
+            except Exception as e:
+                logger.warning(f"Table extraction failed on page {i}: {e}")
+    return text_docs, table_docs, image_pages
+
+def _page_count(data: bytes) -> int:
+    """Page count from the first parser that can open the PDF, 0 if none can"""
+    def plumber_count():
+        with pdfplumber.open(io.BytesIO(data)) as pdf:
+            return len(pdf.pages)
+    counters = [
+        ("pdfplumber", plumber_count),
+        ("PyPDF2", lambda: len(PdfReader(io.BytesIO(data)).pages)),
+        ("pdfinfo", lambda: pdfinfo_from_bytes(data)["Pages"]),
+    ]
+    for name, count in counters:
+        try:
+            return count()
+        except Exception as e:
+            logger.warning(f"Page count with {name} failed: {e}")
+    return 0
+
+def _pdfplumber_all(data: bytes, source: str, n_pages: int) -> Tuple[List[Document], List[Document], Optional[List[int]]]:
+    """Single pdfplumber pass over all pages returning (text_docs, table_docs, image_pages)
+
+    image_pages is None when pdfplumber couldn't read the PDF.
+    """
+    text_docs, table_docs, image_pages = [], [], []
     try:
-        with pdfplumber.open(path) as pdf:
-            for i, page in enumerate(pdf.pages, 1):
-                txt = page.extract_text() or ""
-                if txt.strip():
-                    docs.append(Document(
-                        page_content=txt,
-                        metadata={
-                            "source": path,
-                            "page": i,
-                            "method": "pdfplumber",
-                            "char_count": len(txt)
-                        }
-                    ))
-        logger.info(f"pdfplumber extracted {len(docs)} pages")
+        workers = min(os.cpu_count() or 1, max(1, n_pages // MIN_PAGES_PER_WORKER))
+        ranges = _page_ranges(n_pages, workers)
+        if len(ranges) > 1:
+            # Each worker opens its own copy of the PDF and parses its page range
+            with ProcessPoolExecutor(max_workers=len(ranges), mp_context=MP_CONTEXT) as executor:
+                starts, ends = zip(*ranges)
+                for range_text, range_tables, range_images in executor.map(_pdfplumber_range, repeat(data), repeat(source), starts, ends):
+                    text_docs.extend(range_text)
+                    table_docs.extend(range_tables)
+                    image_pages.extend(range_images)
+        elif ranges:
+            text_docs, table_docs, image_pages = _pdfplumber_range(data, source, *ranges[0])
+        logger.info(f"pdfplumber extracted {len(text_docs)} pages and {len(table_docs)} tables")
     except Exception as e:
         logger.warning(f"pdfplumber failed: {e}")
-    return docs
+        image_pages = None
+    return text_docs, table_docs, image_pages
 
-def _text_pypdf(path: str) -> List[Document]:
+def _text_pypdf(data: bytes, source: str) -> List[Document]:
     docs = []
     try:
-        reader = PdfReader(path)
+        reader = PdfReader(io.BytesIO(data))
         for i, page in enumerate(reader.pages, 1):
             txt = page.extract_text() or ""
             if txt.strip():
                 docs.append(Document(
                     page_content=txt,
                     metadata={
-                        "source": path,
+                        "source": source,
                         "page": i,
                         "method": "pypdf",
                         "char_count": len(txt)
@@ -52,16 +205,47 @@ def _text_pypdf(path: str) -> List[Document]:
         logger.warning(f"PyPDF2 failed: {e}")
     return docs
 
-def _text_ocr(path: str, dpi=150) -> List[Document]:
+def _text_ocr(data: bytes, source: str, pages: List[int], dpi=150) -> List[Document]:
+    """OCR the given 1-based page numbers"""
     docs = []
     try:
-        for i, img in enumerate(convert_from_path(path, dpi=dpi), 1):
-            txt = pytesseract.image_to_string(img)
+        # Never start more OCR processes than there are pages to OCR
+        workers = min(os.cpu_count() or 1, len(pages))
+        texts = {}
+        # tesseract is CPU-bound per page, so OCR pages in parallel processes.
+        # Pages are rasterized in batches so workers start on the first pages
+        # while later ones are still rendering; grayscale cuts pixel data 3x.
+        # The PDF is written to disk once; convert_from_bytes would write and
+        # re-parse a fresh temp copy for every batch.
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pdf_path = os.path.join(tmp_dir, "scan.pdf")
+            with open(pdf_path, "wb") as fh:
+                fh.write(data)
+            
+            def rasterized():
+                for first, last in _page_runs(pages, workers):
+                    images = convert_from_path(pdf_path, dpi=dpi, grayscale=True, first_page=first,
+                                               last_page=last, thread_count=workers)
+                    yield from enumerate(images, first)
+            
+            if workers == 1:
+                # One page (or core) isn't worth a worker process and its tessdata
+                # load; OCR in-process, where _ocr_image runs pytesseract
+                for i, img in rasterized():
+                    texts[i] = _ocr_image(img)
+            else:
+                with ProcessPoolExecutor(max_workers=workers, mp_context=MP_CONTEXT,
+                                         initializer=_init_ocr_worker) as executor:
+                    futures = {executor.submit(_ocr_image, img): i for i, img in rasterized()}
+                    for future in as_completed(futures):
+                        texts[futures[future]] = future.result()
+        for i in sorted(texts):
+            txt = texts[i]
             if txt.strip():
                 docs.append(Document(
                     page_content=txt,
                     metadata={
-                        "source": path,
+                        "source": source,
                         "page": i,
                         "method": "ocr",
                         "char_count": len(txt)
@@ -72,70 +256,31 @@ def _text_ocr(path: str, dpi=150) -> List[Document]:
         logger.error(f"OCR failed: {e}")
     return docs
 
-def _tables(path: str) -> List[Document]:
-    docs = []
-    try:
-        with pdfplumber.open(path) as pdf:
-            for p, page in enumerate(pdf.pages, 1):
-                tables = page.extract_tables() or []
-                for t_idx, tbl in enumerate(tables, 1):
-                    if not tbl:
-                        continue
-                        
-                    # Better table processing
-                    rows = []
-                    headers = None
-                    
-                    for row_idx, row in enumerate(tbl):
-                        if not any(cell for cell in row if cell):  # Skip empty rows
-                            continue
-                            
-                        clean_row = [str(cell or "").strip() for cell in row]
-                        
-                        if row_idx == 0 and not headers:
-                            headers = clean_row
-                            rows.append("HEADERS: " + " | ".join(headers))
-                        else:
-                            if headers:
-                                row_data = []
-                                for i, cell in enumerate(clean_row):
-                                    col_name = headers[i] if i < len(headers) else f"Col{i+1}"
-                                    row_data.append(f"{col_name}: {cell}")
-                                rows.append(" | ".join(row_data))
-                            else:
-                                rows.append(" | ".join(clean_row))
-                    
-                    if rows:
-                        table_content = f"TABLE {t_idx} (Page {p}):\n" + "\n".join(rows)
-                        docs.append(Document(
-                            page_content=table_content,
-                            metadata={
-                                "source": path,
-                                "page": p,
-                                "type": "table",
-                                "table_id": t_idx,
-                                "rows": len(rows),
-                                "method": "table_extraction"
-                            }
-                        ))
-        logger.info(f"Extracted {len(docs)} tables")
-    except Exception as e:
-        logger.warning(f"Table extraction failed: {e}")
-    return docs
-
 def extract_from_pdf(uploaded_file, enable_ocr=True) -> List[Document]:
-    tmp = tempfile.mktemp(suffix=".pdf")
     try:
-        with open(tmp, "wb") as fh:
-            fh.write(uploaded_file.getbuffer())
+        # Work from the in-memory upload; only OCR rasterization touches disk
+        data = bytes(uploaded_file.getbuffer())
+        source = uploaded_file.name
+        
+        n_pages = _page_count(data)
         
-        # Try multiple extraction methods
-        docs = (_text_pdfplumber(tmp) or 
-                _text_pypdf(tmp) or 
-                (_text_ocr(tmp) if enable_ocr else []))
+        # One pdfplumber pass yields both page text and tables, with PyPDF2 as fallback
+        docs, table_docs, image_pages = _pdfplumber_all(data, source, n_pages)
+        docs = docs or _text_pypdf(data, source)
+        
+        # OCR only the pages that came back without a text layer but with images
+        # (scans); blank and vector-only pages never reach Tesseract
+        if enable_ocr:
+            if image_pages is None:
+                # No per-page image info without pdfplumber: OCR the whole
+                # document only when no extractor found any text, as before
+                image_pages = [] if docs else list(range(1, n_pages + 1))
+            have_text = {d.metadata["page"] for d in docs}
+            missing = [p for p in image_pages if p not in have_text]
+            if missing:
+                logger.info(f"OCR for {len(missing)} of {n_pages} pages without a text layer")
+                docs = sorted(docs + _text_ocr(data, source, missing), key=lambda d: d.metadata["page"])
         
-        # Always try to extract tables
-        table_docs = _tables(tmp)
         docs.extend(table_docs)
         
         # Update metadata with original filename
@@ -155,8 +300,3 @@ def extract_from_pdf(uploaded_file, enable_ocr=True) -> List[Document]:
             page_content=f"Error extracting PDF: {e}",
             metadata={"source": uploaded_file.name, "error": str(e)}
         )]
-    finally:
-        try:
-            os.remove(tmp)
-        except Exception:
-            pass
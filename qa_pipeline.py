@@ -1,21 +1,230 @@
 import logging
 import os
+import re
+import shutil
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
+import chromadb
+import numpy as np
+import ollama
+from langchain.embeddings import CacheBackedEmbeddings
 from langchain.schema import Document
+from langchain.storage import LocalFileStore
+from langchain_core.embeddings import Embeddings
+from langchain_core.globals import set_llm_cache
+from langchain_community.cache import SQLiteCache
 from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings import OllamaEmbeddings
 from langchain_community.chat_models import ChatOllama
-from langchain.prompts import ChatPromptTemplate, PromptTemplate
-from langchain.retrievers.multi_query import MultiQueryRetriever
+from langchain.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.runnables import RunnableLambda, RunnablePassthrough
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
+# Optional: exact token counts for the context budget; without it tokens are
+# estimated conservatively at ~2 characters each
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
 logger = logging.getLogger(__name__)
 
-# Persistence directory for vector database
+# Persistence directory for vector database; PersistentClient creates it on first use
 PERSIST_DIRECTORY = "./chromadb"
-os.makedirs(PERSIST_DIRECTORY, exist_ok=True)
+
+# On-disk embedding cache keyed by SHA-256 of chunk text
+EMBED_CACHE_DIRECTORY = "./emb_cache"
+
+# On-disk LLM response cache: a repeated question over the same context
+# (same prompt, model and temperature) is answered without calling Ollama
+LLM_CACHE_PATH = "./llm_cache.db"
+set_llm_cache(SQLiteCache(database_path=LLM_CACHE_PATH))
+
+EMBED_MODEL = "nomic-embed-text"
+CHROMA_BATCH_SIZE = 2000
+CHUNK_SIZE = 1500
+
+# Retrieved chunks actually placed in the prompt after priority re-ranking
+CONTEXT_TOP_K = 10
+
+# Context window requested from Ollama (num_ctx) and budgeted against when
+# packing retrieved chunks; part of it is kept free for the answer
+CONTEXT_TOKEN_BUDGET = 4096
+ANSWER_RESERVE_TOKENS = 512
+
+# HNSW index settings, applied when the collection is first created.
+# hnswlib searches with max(search_ef, k), so the wider search_ef lifts recall
+# for smaller k (e.g. debug_retrieval); num_threads parallelizes index builds
+HNSW_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 32,
+    "hnsw:construction_ef": 256,
+    "hnsw:search_ef": 128,
+    "hnsw:num_threads": os.cpu_count() or 1,
+}
+
+# Chunk priority keywords, highest first:
+#   critical - financial summaries and totals
+#   high     - calculations and aggregates
+#   medium   - individual records
+_PRIORITY_TERMS = {
+    "critical": ["total records:", "total amount:", "financial summary", "total:", "sum:", "breakdown"],
+    "high": ["calculation:", "average:", "count:", "distribution"],
+    "medium": ["record", "row", "data"],
+}
+_PRIORITY_FLAGS = {
+    "critical": "contains_totals",
+    "high": "contains_calculations",
+    "medium": "contains_records",
+}
+# One alternation scanned in a single pass; the named group says which tier matched.
+# Case-insensitive matching avoids a lowercased copy of every chunk.
+_PRIORITY_PATTERN = re.compile("|".join(
+    f"(?P<{name}>" + "|".join(re.escape(t) for t in terms) + ")"
+    for name, terms in _PRIORITY_TERMS.items()
+), re.IGNORECASE)
+_PRIORITY_RANK = {name: rank for rank, name in enumerate(_PRIORITY_TERMS)}
+
+def _classify_priority(content: str) -> str:
+    """Highest priority tier whose keywords appear in content, else 'low'"""
+    best = None
+    for match in _PRIORITY_PATTERN.finditer(content):
+        tier = match.lastgroup
+        if best is None or _PRIORITY_RANK[tier] < _PRIORITY_RANK[best]:
+            best = tier
+            if best == "critical":
+                break
+    return best or "low"
+
+def _rerank_by_priority(docs: List[Document], top_k: int = CONTEXT_TOP_K) -> List[Document]:
+    """Keep the top_k chunks, highest priority tier first, retrieval order within a tier"""
+    unranked = len(_PRIORITY_RANK)
+    return sorted(docs, key=lambda d: _PRIORITY_RANK.get(d.metadata.get("priority"), unranked))[:top_k]
+
+# cl100k_base is not the Ollama model's own tokenizer, but close enough to budget with
+_ENCODING = None
+_ENCODING_FAILED = False
+
+def _count_tokens(text: str) -> int:
+    global _ENCODING, _ENCODING_FAILED
+    if tiktoken is not None and _ENCODING is None and not _ENCODING_FAILED:
+        # The BPE file is downloaded on first use, which fails on offline machines
+        try:
+            _ENCODING = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            logger.warning(f"tiktoken encoding unavailable, estimating tokens: {e}")
+            _ENCODING_FAILED = True
+    if _ENCODING is None:
+        # Digit- and "|"-heavy row text runs close to 2 characters per token;
+        # overestimating keeps the packed context inside num_ctx
+        return len(text) // 2 + 1
+    return len(_ENCODING.encode(text))
+
+def _fit_token_budget(docs: List[Document], budget: int) -> List[Document]:
+    """Leading docs whose combined page_content fits in budget tokens"""
+    kept, used = [], 0
+    for doc in docs:
+        used += _count_tokens(doc.page_content)
+        if used > budget:
+            break
+        kept.append(doc)
+    return kept
+
+def _format_context(docs: List[Document]) -> str:
+    """Chunk text only, so the prompt carries no Document reprs or metadata"""
+    return "\n---\n".join(doc.page_content for doc in docs)
+
+class OllamaBatchEmbeddings(Embeddings):
+    """
+    Embeddings via Ollama's batched /api/embed endpoint
+    
+    OllamaEmbeddings issues one HTTP request per text; here each request
+    carries batch_size texts, so ingesting N chunks costs N/batch_size
+    round-trips instead of N.
+    """
+    
+    def __init__(self, model: str = EMBED_MODEL, batch_size: int = 32, client: ollama.Client = None):
+        self.model = model
+        self.batch_size = batch_size
+        self.client = client or ollama.Client()
+    
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        embeddings = []
+        for i in range(0, len(texts), self.batch_size):
+            resp = self.client.embed(model=self.model, input=texts[i:i + self.batch_size])
+            embeddings.extend(resp["embeddings"])
+        return embeddings
+    
+    def embed_query(self, text: str) -> List[float]:
+        return self.client.embed(model=self.model, input=text)["embeddings"][0]
+
+# Built once and shared across calls: the embedder keeps its ollama.Client
+# connection pool, the chat models just skip re-construction
+_EMBEDDER = None
+_LLMS = {}
+
+def _cached_embedder() -> CacheBackedEmbeddings:
+    """Batched Ollama embedder that skips chunks embedded on a previous run"""
+    global _EMBEDDER
+    if _EMBEDDER is None:
+        _EMBEDDER = CacheBackedEmbeddings.from_bytes_store(
+            OllamaBatchEmbeddings(),
+            LocalFileStore(EMBED_CACHE_DIRECTORY),
+            namespace=EMBED_MODEL,
+            key_encoder="sha256"
+        )
+    return _EMBEDDER
+
+def _get_llm(model_name: str) -> ChatOllama:
+    """One ChatOllama per model, built on first use"""
+    llm = _LLMS.get(model_name)
+    if llm is None:
+        llm = _LLMS[model_name] = ChatOllama(model=model_name, temperature=0, num_ctx=CONTEXT_TOKEN_BUDGET)
+    return llm
+
+def _open_vector_db(embedder: Embeddings) -> Chroma:
+    """Open (or create) the collection through chromadb's PersistentClient"""
+    client = chromadb.PersistentClient(path=PERSIST_DIRECTORY)
+    return Chroma(
+        client=client,
+        collection_name="financial_rag",
+        embedding_function=embedder,
+        collection_metadata=HNSW_METADATA
+    )
+
+# Optimized splitter for Excel financial data, built once at import
+_SPLITTER = RecursiveCharacterTextSplitter(
+    chunk_size=CHUNK_SIZE,  # Smaller chunks to preserve context
+    chunk_overlap=300,    # More overlap to maintain continuity
+    separators=[
+        "\n\n", "\n", 
+        "===", "TOTAL", "SUMMARY", "BREAKDOWN",
+        "---", "|", ",", " "
+    ],
+    keep_separator=True,
+    add_start_index=True
+)
+
+def _split_and_merge(doc: Document, max_size: int = CHUNK_SIZE) -> List[Document]:
+    """Split one document, then greedily merge its adjacent fragments while they fit in max_size"""
+    merged, ends = [], []
+    for chunk in _SPLITTER.split_documents([doc]):
+        prev = merged[-1] if merged else None
+        start = chunk.metadata["start_index"]
+        if prev is not None and start >= 0 and prev.metadata["start_index"] >= 0:
+            # Re-slice the parent so the splitter's overlap isn't duplicated. start_index
+            # comes from str.find and can point at an earlier copy of repeated text, so
+            # only merge when the slice still reaches past prev's end and can't shrink it
+            prev_start = prev.metadata["start_index"]
+            end = start + len(chunk.page_content)
+            if prev_start <= start and end >= ends[-1] and end - prev_start <= max_size:
+                prev.page_content = doc.page_content[prev_start:end]
+                ends[-1] = end
+                continue
+        merged.append(chunk)
+        ends.append(start + len(chunk.page_content))
+    return merged
 
 def create_vector_db(documents: List[Document]) -> Chroma:
     """
@@ -28,59 +237,49 @@ def create_vector_db(documents: List[Document]) -> Chroma:
     """
     logger.info(f"Creating vector DB from {len(documents)} documents")
     
-    # Optimized splitter for Excel financial data
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1500,      # Smaller chunks to preserve context
-        chunk_overlap=300,    # More overlap to maintain continuity
-        separators=[
-            "\n\n", "\n", 
-            "===", "TOTAL", "SUMMARY", "BREAKDOWN",
-            "---", "|", ",", " "
-        ],
-        keep_separator=True
-    )
-    
-    chunks = splitter.split_documents(documents)
+    # Split each document, then fold the small fragments the "|" and "," separators
+    # leave behind into their neighbours so they don't each cost an embedding.
+    # Fragments never merge across documents, so summaries, pages, sheets and
+    # tables keep their own chunks and metadata
+    chunks = [chunk for doc in documents for chunk in _split_and_merge(doc)]
+    logger.info(f"Split {len(documents)} documents into {len(chunks)} chunks")
     
     # Enhanced metadata for better retrieval prioritization
     for i, chunk in enumerate(chunks):
         chunk.metadata["chunk_id"] = i
         chunk.metadata["chunk_size"] = len(chunk.page_content)
         
-        content = chunk.page_content.lower()
-        
-        # Highest priority: Financial summaries and totals
-        if any(term in content for term in [
-            "total records:", "total amount:", "financial summary", 
-            "total:", "sum:", "breakdown"
-        ]):
-            chunk.metadata["priority"] = "critical"
-            chunk.metadata["contains_totals"] = True
-            
-        # High priority: Calculations and aggregates  
-        elif any(term in content for term in [
-            "calculation:", "average:", "count:", "distribution"
-        ]):
-            chunk.metadata["priority"] = "high"
-            chunk.metadata["contains_calculations"] = True
-            
-        # Medium priority: Individual records
-        elif any(term in content for term in ["record", "row", "data"]):
-            chunk.metadata["priority"] = "medium" 
-            chunk.metadata["contains_records"] = True
-        else:
-            chunk.metadata["priority"] = "low"
+        priority = _classify_priority(chunk.page_content)
+        chunk.metadata["priority"] = priority
+        if priority in _PRIORITY_FLAGS:
+            chunk.metadata[_PRIORITY_FLAGS[priority]] = True
     
-    # Create vector store
-    embedder = OllamaEmbeddings(model="nomic-embed-text")
-    vector_db = Chroma.from_documents(
-        chunks, 
-        embedder, 
-        collection_name="financial_rag",
-        persist_directory=PERSIST_DIRECTORY
-    )
+    # Create vector store, then insert in large batches rather than one mega-call
+    embedder = _cached_embedder()
+    vector_db = _open_vector_db(embedder)
+    
+    def embed_batch(batch: List[Document]):
+        texts = [c.page_content for c in batch]
+        ids = [f"{c.metadata.get('source', '')}:chunk_{c.metadata['chunk_id']}" for c in batch]
+        # One contiguous float32 matrix per batch, which Chroma takes as-is instead
+        # of converting N Python lists; the embedding cache itself stays JSON lists
+        embeddings = np.asarray(embedder.embed_documents(texts), dtype=np.float32)
+        return texts, embeddings, [c.metadata for c in batch], ids
     
-    vector_db.persist()
+    # Drop whatever an earlier ingest of these files left behind; deterministic
+    # ids alone would leave stale chunks past the end of a shorter re-upload
+    sources = sorted({c.metadata["source"] for c in chunks if "source" in c.metadata})
+    if sources:
+        vector_db._collection.delete(where={"source": {"$in": sources}})
+    
+    # A background thread embeds batch N+1 while this thread writes batch N,
+    # so ingest time is roughly max(embed, persist) rather than their sum
+    batches = [chunks[i:i + CHROMA_BATCH_SIZE] for i in range(0, len(chunks), CHROMA_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        for texts, embeddings, metadatas, ids in executor.map(embed_batch, batches):
+            vector_db._collection.upsert(ids=ids, embeddings=embeddings, documents=texts, metadatas=metadatas)
+    
+    # PersistentClient writes through on every add; no explicit persist() needed
     logger.info(f"Vector DB created with {len(chunks)} chunks")
     return vector_db
 
@@ -89,50 +288,27 @@ def process_question_with_rag(question: str, vector_db: Chroma, model_name: str)
     Process financial questions with optimized RAG retrieval
     
     Key improvements:
-    1. Increased k parameter for better Excel data coverage
-    2. Multi-query retrieval for comprehensive results
-    3. Strict anti-hallucination prompt
+    1. One MMR retrieval (k=40 of 200 candidates) for diverse coverage
+    2. Priority re-ranking trims the prompt to the top CONTEXT_TOP_K chunks
+    3. Context capped to the model's token window, leaving room for the answer
+    4. Strict anti-hallucination prompt
     """
     if vector_db is None:
         return "Please upload and process a financial document first."
 
     try:
-        llm = ChatOllama(model=model_name, temperature=0)
-
-        # Multi-query generation for comprehensive retrieval
-        query_prompt = PromptTemplate(
-            input_variables=["question"],
-            template="""
-You are a financial analyst generating search queries for document retrieval.
-Create 3 different search queries to find comprehensive information.
-
-Original question: {question}
-
-Generate these specific queries:
-1. Query for summary and totals
-2. Query for detailed data records  
-3. Query for calculations and breakdowns
-
-Query 1:
-Query 2:
-Query 3:
-            """.strip()
-        )
+        llm = _get_llm(model_name)
 
-        # CRITICAL: Increased k for chunked Excel data coverage
-        # Excel data gets split into many chunks, so we need more retrieval
-        base_retriever = vector_db.as_retriever(
+        # Single MMR search: fetch a wide candidate pool, keep a diverse top 40.
+        # Replaces k=100 + multi-query expansion (3 extra LLM calls, 4 searches)
+        retriever = vector_db.as_retriever(
+            search_type="mmr",
             search_kwargs={
-                "k": 100,  # Significantly increased from 50 to 100
+                "k": 40,
+                "fetch_k": 200,
+                "lambda_mult": 0.5,
             }
         )
-        
-        retriever = MultiQueryRetriever.from_llm(
-            base_retriever,
-            llm,
-            prompt=query_prompt,
-            include_original=True  # Fixed typo from "Trueacc"
-        )
 
         # Enhanced financial analysis prompt
         financial_prompt = """
@@ -159,10 +335,20 @@ FINANCIAL ANALYSIS:
         """.strip()
         
         prompt_chain = ChatPromptTemplate.from_template(financial_prompt)
+        
+        # Whatever the template, question and answer don't use is left for context
+        context_budget = (CONTEXT_TOKEN_BUDGET - ANSWER_RESERVE_TOKENS
+                          - _count_tokens(financial_prompt) - _count_tokens(question))
 
-        # Build the RAG chain
+        # Build the RAG chain; totals and calculations outrank plain records
         rag_chain = (
-            {"context": retriever, "question": RunnablePassthrough()}
+            {
+                "context": retriever
+                | RunnableLambda(_rerank_by_priority)
+                | RunnableLambda(lambda docs: _fit_token_budget(docs, context_budget))
+                | RunnableLambda(_format_context),
+                "question": RunnablePassthrough(),
+            }
             | prompt_chain
             | llm
             | StrOutputParser()
@@ -185,12 +371,7 @@ FINANCIAL ANALYSIS:
 def load_existing_vector_db() -> Chroma:
     """Load existing vector database from disk"""
     try:
-        embedder = OllamaEmbeddings(model="nomic-embed-text")
-        vector_db = Chroma(
-            collection_name="financial_rag",
-            embedding_function=embedder,
-            persist_directory=PERSIST_DIRECTORY
-        )
+        vector_db = _open_vector_db(_cached_embedder())
         logger.info("Loaded existing vector database")
         return vector_db
     except Exception as e:
@@ -204,12 +385,9 @@ def debug_retrieval(question: str, vector_db: Chroma, k: int = 20) -> List[Docum
         logger.info(f"Retrieved {len(docs)} documents for: '{question[:50]}...'")
         
         # Show priority distribution
-        priorities = {}
-        for doc in docs:
-            priority = doc.metadata.get("priority", "unknown")
-            priorities[priority] = priorities.get(priority, 0) + 1
+        priorities = Counter(doc.metadata.get("priority", "unknown") for doc in docs)
         
-        logger.info(f"Priority distribution: {priorities}")
+        logger.info(f"Priority distribution: {dict(priorities)}")
         return docs
     except Exception as e:
         logger.error(f"Debug retrieval failed: {e}")
@@ -219,9 +397,7 @@ def clear_vector_db():
     """Clear the vector database for fresh start"""
     try:
         if os.path.exists(PERSIST_DIRECTORY):
-            import shutil
             shutil.rmtree(PERSIST_DIRECTORY)
-            os.makedirs(PERSIST_DIRECTORY, exist_ok=True)
             logger.info("Vector database cleared")
     except Exception as e:
         logger.error(f"Failed to clear vector DB: {e}")